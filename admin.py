@@ -17,6 +17,8 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from django.contrib import admin
+from django.db.models import Q
+from cams.search import contactable_search
 from cams.models import (Person, Organisation, Member, Contact,
                          Player, Group, Actor, Event, Fair, Role,
                          Comment, EventComment, Application, EventApplication,
@@ -66,9 +68,33 @@ class RecordAdmin(admin.ModelAdmin):
     list_display = ['created', 'status']
 
 
-class ContactableAdmin(RecordAdmin):
+# Use the address book search index rather than sub-string matches on the
+# search_fields, which can't use any database index.  Each search term has to
+# match either the indexed entry behind search_contactable or one of the
+# search_extra_fields.
+class ContactableSearchMixin(object):
+    search_contactable = 'pk'
+    search_extra_fields = []
+
+    def get_search_results(self, request, queryset, search_term):
+        for term in search_term.split():
+            q = Q(**{'{}__in'.format(self.search_contactable):
+                     contactable_search.match(term)})
+            for field in self.search_extra_fields:
+                q |= Q(**{'{}__icontains'.format(field): term})
+            queryset = queryset.filter(q)
+        return queryset, False
+
+
+class ContactableAdmin(ContactableSearchMixin, RecordAdmin):
     inlines = [ContactInline]
 
+    def get_queryset(self, request):
+        qs = super(ContactableAdmin, self).get_queryset(request)
+        if 'current_groups' in self.list_display:
+            qs = qs.prefetch_related('group_set')
+        return qs
+
 
 class PersonAdmin(ContactableAdmin):
     list_per_page = 50
@@ -99,6 +125,7 @@ class OrganisationAdmin(ContactableAdmin):
 class MemberAdmin(ContactableAdmin):
     list_display = ['person', 'organisation', 'title'] \
                    + RecordAdmin.list_display
+    list_select_related = ['person', 'organisation']
     ordering = ('person', )
     list_per_page = 50
     search_fields = ['person__first_name', 'person__middle_name',
@@ -111,6 +138,7 @@ class MemberAdmin(ContactableAdmin):
 
 class GroupAdmin(admin.ModelAdmin):
     list_display = ['__unicode__', 'description']
+    list_select_related = ['board']
     search_fields = ['name', 'board']
     list_filter = ['board']
 
@@ -120,11 +148,14 @@ class FairAdmin(admin.ModelAdmin):
     ordering = ('-date', )
 
 
-class PlayerAdmin(RecordAdmin):
+class PlayerAdmin(ContactableSearchMixin, RecordAdmin):
+    search_contactable = 'person'
+    search_extra_fields = ['user__username']
     search_fields = ['person__first_name', 'person__middle_name',
                      'person__last_name', 'person__nickname',
                      'user__username']
     list_display = ['person'] + RecordAdmin.list_display
+    list_select_related = ['person']
     list_per_page = 30
 
 
@@ -132,18 +163,22 @@ class EventAdmin(RecordAdmin):
     search_fields = ['name', 'org__name']
     list_display = ['__unicode__', 'date', 'time', 'org', 'owner'] \
                    + RecordAdmin.list_display
+    list_select_related = ['org', 'owner']
     list_display_links = ['__unicode__']
     list_per_page = 30
     ordering = ('-date', '-time')
     list_filter = RecordAdmin.list_filter + ['fair']
 
 
-class ActorAdmin(RecordAdmin):
+class ActorAdmin(ContactableSearchMixin, RecordAdmin):
+    search_contactable = 'person'
+    search_extra_fields = ['event__name']
     search_fields = ['event__name', 'person__first_name',
                      'person__middle_name',
                      'person__last_name',
                      'person__nickname']
     list_display = ['date', '__unicode__'] + RecordAdmin.list_display
+    list_select_related = ['person', 'event']
     list_display_links = ['date', '__unicode__']
     list_per_page = 30
     ordering = ('-event__date', )
@@ -153,6 +188,7 @@ class ActorAdmin(RecordAdmin):
 class CommentAdmin(RecordAdmin):
     list_display = ['created', 'author', '__unicode__'] \
                    + RecordAdmin.list_display
+    list_select_related = ['author__person']
     ordering = ('-created', )
     raw_id_fields = ['author']
 
@@ -168,6 +204,7 @@ class ApplicationAdmin(admin.ModelAdmin):
 
 class EventApplicationAdmin(ApplicationAdmin):
     list_display = ['person', 'event'] + RecordAdmin.list_display
+    list_select_related = ['person', 'event']
     raw_id_fields = ApplicationAdmin.raw_id_fields + ['event']
 
 
@@ -16,7 +16,8 @@
 # You should have received a copy of the GNU General Public License along with
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from cams.models import Record, Contactable, Contact, Member, Role
+from cams.models import (Record, Contactable, Contact, Person, Organisation,
+                         Member, Role)
 
 # -----------------------------------------------------------------------------
 # contacts
@@ -36,59 +37,97 @@ def iterate_group_contacts (group): # ToDo: move into group model ?
     for it, role in iterate_group_o_contacts (roles):
         yield it, role
 
+# The resolvers below load everything they need with a fixed number of bulk
+# queries regardless of the number of roles, then apply the contact fallback
+# rules in memory.  When several rows match, the first one by primary key is
+# used (or by name then primary key for members).
+
+def _first_by (objs, key):
+    first = dict ()
+    for obj in objs:
+        first.setdefault (getattr (obj, key), obj)
+    return first
+
+def _get_contacts (obj_ids):
+    return _first_by (Contact.objects.filter (obj__in = obj_ids).order_by
+                      ('pk'), 'obj_id')
+
+def _get_members (key, obj_ids, related):
+    members = Member.objects.filter (**{'{}__in'.format (key): obj_ids})
+    members = members.select_related (related).order_by ('basic_name', 'pk')
+    return members
+
 def iterate_group_p_contacts (roles):
     roles_people = roles.filter (contactable__type = Contactable.PERSON)
+    people_ids = roles_people.order_by ().values ('contactable')
     roles_people = roles_people.order_by ('contactable__person__last_name')
+    roles_people = list (roles_people.select_related ('contactable'))
+    if not roles_people:
+        return
+
+    people = dict ((p.pk, p) for p in
+                   Person.objects.filter (pk__in = people_ids))
+    contacts = _get_contacts (people_ids)
+    members_qs = _get_members ('person', people_ids, 'organisation')
+    members = _first_by (members_qs, 'person_id')
+    members_ids = members_qs.order_by ()
+    members_contacts = _get_contacts (members_ids.values ('pk'))
+    orgs_contacts = _get_contacts (members_ids.values ('organisation'))
 
     for role in roles_people:
         it = role.contactable
         org_name = ''
-        c = Contact.objects.filter (obj = it)
+        c = contacts.get (it.pk)
         if c:
-            c = c[0]
             ctype = 'person'
         else:
-            member = Member.objects.filter (person = it)
+            member = members.get (it.pk)
             if member:
-                member = member[0]
                 org_name = member.organisation.name
-                c = Contact.objects.filter (obj = member)
+                c = members_contacts.get (member.pk)
                 if c:
-                    c = c[0]
                     ctype = 'member'
                 else:
-                    c = Contact.objects.filter (obj = member.organisation)
+                    c = orgs_contacts.get (member.organisation_id)
                     if c:
-                        c = c[0]
                         ctype = 'org'
         if c:
-            yield ExportContact (it.person, ctype, org_name, c), role
+            yield ExportContact (people[it.pk], ctype, org_name, c), role
 
 def iterate_group_o_contacts (roles):
     roles_orgs = roles.filter (contactable__type = Contactable.ORGANISATION)
+    orgs_ids = roles_orgs.order_by ().values ('contactable')
     roles_orgs = roles_orgs.order_by ('contactable__organisation__name')
+    roles_orgs = list (roles_orgs.select_related ('contactable'))
+    if not roles_orgs:
+        return
+
+    orgs = dict ((o.pk, o) for o in
+                 Organisation.objects.filter (pk__in = orgs_ids))
+    contacts = _get_contacts (orgs_ids)
+    members_qs = _get_members ('organisation', orgs_ids, 'person')
+    members = _first_by (members_qs, 'organisation_id')
+    members_ids = members_qs.order_by ()
+    members_contacts = _get_contacts (members_ids.values ('pk'))
+    people_contacts = _get_contacts (members_ids.values ('person'))
 
     for role in roles_orgs:
         it = role.contactable
-        c = Contact.objects.filter (obj = it)
+        c = contacts.get (it.pk)
         p = None
         if c:
-            c = c[0]
             c_type = 'org'
         else:
-            member = Member.objects.filter (organisation = it)
+            member = members.get (it.pk)
             if member:
-                member = member[0]
-                c = Contact.objects.filter (obj = member)
+                c = members_contacts.get (member.pk)
                 if c:
                     p = member.person
-                    c = c[0]
                     c_type = 'member'
                 else:
-                    c = Contact.objects.filter (obj = member.person)
+                    c = people_contacts.get (member.person_id)
                     if c:
                         p = member.person
-                        c = c[0]
                         c_type = 'person'
         if c:
-            yield ExportContact (p, c_type, it.organisation.name, c), role
+            yield ExportContact (p, c_type, orgs[it.pk].name, c), role
@@ -18,11 +18,20 @@
 
 import os
 import csv
+import mmap
+import zlib
+import json
+import time
+import sqlite3
 import datetime
 import logging
+import threading
+import atexit
+import Queue
+from collections import OrderedDict
 from django.conf.urls import url as django_url
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 
 CAMS_VERSION = (0, 6)
 
@@ -109,10 +118,7 @@ class CSVFileResponse(object):
         self._csv.writerow(fields)
 
     def write(self, values):
-        values_utf8 = []
-        for v in values:
-            values_utf8.append(v.encode('utf-8'))
-        self._csv.writerow(values_utf8)
+        self._csv.writerow([v.encode('utf-8') for v in values])
 
     def set_file_name(self, f):
         self._resp['Content-Disposition'] = \
@@ -122,25 +128,154 @@ class CSVFileResponse(object):
     def response(self):
         return self._resp
 
+
+# Streamed variant for large exports: the rows are taken from an iterator and
+# written in chunks through a reusable buffer so the memory usage does not
+# depend on the number of rows.  Any rows passed to write() before the
+# response is sent are output first.
+class CSVStreamResponse(CSVFileResponse):
+    chunk_rows = 256
+
+    def __init__(self, fields, rows, **kwargs):
+        self._buf = CSVStreamResponse.Buffer()
+        self._csv = csv.writer(self._buf, **kwargs)
+        self._csv.writerow(fields)
+        self._resp = StreamingHttpResponse(self._iter_chunks(rows),
+                                           content_type='text/csv')
+
+    def _iter_chunks(self, rows):
+        n = 0
+        for values in rows:
+            self.write(values)
+            n += 1
+            if n == self.chunk_rows:
+                yield self._buf.flush()
+                n = 0
+        yield self._buf.flush()
+
+
+    class Buffer(object):
+        def __init__(self):
+            self._data = list()
+
+        def write(self, data):
+            self._data.append(data)
+
+        def flush(self):
+            data = ''.join(self._data)
+            del self._data[:]
+            return data
+
 # -----------------------------------------------------------------------------
 # History
 
+def format_history_fields(fields):
+    msg_str = []
+    for k, x in fields.items():
+        if isinstance(x, dict):
+            x = u':'.join([x['otype'], unicode(x['oid'])])
+        else:
+            x = x.replace('\\', '\\\\').replace('\"', '\\\"')
+            x = u'\"{}\"'.format(x)
+        msg_str.append(u'{}: {}'.format(k, x))
+    return u', '.join(msg_str)
+
+def dump_history_json(t, uid, otype, oid, action, fields):
+    return json.dumps(OrderedDict([('t', t), ('uid', uid), ('otype', otype),
+                                   ('oid', oid), ('action', action),
+                                   ('fields', fields)]),
+                      separators=(',', ':'))
+
+# Values are not escaped for new lines in the text format, so lines which
+# don't start with '[' are the continuation of the previous entry.  Entries
+# which can't be parsed, such as a partially written last one, are skipped and
+# the numbers of their first lines are returned.
+def convert_history_log(in_file_name, out_file_name):
+    skipped = list()
+    with open(in_file_name, 'rb') as in_file:
+        with open(out_file_name, 'wb') as out_file:
+            entry = None
+            for n, line in enumerate(in_file, 1):
+                line = line.rstrip(b'\r\n')
+                if entry is not None and not line.startswith((b'[', b'{')):
+                    entry[1].append(line)
+                    continue
+                if entry is not None:
+                    _convert_history_entry(out_file, skipped, *entry)
+                entry = (n, [line])
+            if entry is not None:
+                _convert_history_entry(out_file, skipped, *entry)
+    return skipped
+
+def _convert_history_entry(out_file, skipped, n, lines):
+    line = b'\n'.join(lines).strip()
+    if not line:
+        return
+    try:
+        if line.startswith(b'{'):
+            json.loads(line)
+        else:
+            pline = HistoryParser.Line(line)
+            t = time.mktime(pline.parse_date_time().timetuple())
+            uid = pline.parse_ref()[1]
+            otype, oid = pline.parse_ref()
+            action = pline.parse_block()
+            line = dump_history_json(t, uid, otype, oid, action,
+                                     pline.parse_fields())
+    except Exception:
+        skipped.append(n)
+        return
+    out_file.write(line + b'\n')
+
+
+class HistoryJSONFormatter(logging.Formatter):
+    def format(self, record):
+        return dump_history_json(record.created, record.uid, record.otype,
+                                 record.oid, record.action,
+                                 getattr(record, 'fields', {}))
+
+
+# History entries are normally written with cams.history_format.  They can also
+# be written as JSON lines by using HistoryJSONFormatter with the logger
+# handlers: the parser detects each line format automatically, and existing
+# logs can be converted with convert_history_log().
+#
+# When queue_size is set, the log records are created in the calling thread
+# (so the time stamps are the same) but passed to a background thread via a
+# bounded queue to be written by the logger handlers.  The thread is started
+# on first use in each process.  Logging blocks when the queue is full, and all
+# the pending records are written on shutdown.
 class HistoryLogger(object):
-    def __init__(self, logger_name, plain_logger_name=None):
+    def __init__(self, logger_name, plain_logger_name=None, queue_size=None):
         self._logger = logging.getLogger(logger_name)
         if plain_logger_name:
             self._plain_logger = logging.getLogger(plain_logger_name)
         else:
             self._plain_logger = None
+        self._queue_size = queue_size
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if queue_size:
+            atexit.register(self._shutdown)
+
+    def flush(self):
+        if self._queue is not None and self._pid == os.getpid():
+            self._queue.join()
+
+    def _shutdown(self):
+        if self._queue is not None and self._pid == os.getpid():
+            self._queue.put(None)
+            self._queue.join()
 
     def create(self, user, obj, fields):
-        self._log(user, obj, 'CREATE', self._make_msg(obj, fields))
+        self._log(user, obj, 'CREATE', self._make_fields(obj, fields))
 
     def create_form(self, user, form, extra=[]):
         self.create(user, form.instance, form.fields.keys() + extra)
 
     def edit(self, user, obj, fields):
-        self._log(user, obj, 'EDIT', self._make_msg(obj, fields))
+        self._log(user, obj, 'EDIT', self._make_fields(obj, fields))
 
     def edit_form(self, user, form, extra=[]):
         changed_data = form.changed_data + extra
@@ -157,96 +292,343 @@ class HistoryLogger(object):
             self.edit(user, form.instance, changed_fields)
 
     def delete(self, user, obj):
-        self._log(user, obj, 'DELETE', '')
+        self._log(user, obj, 'DELETE', OrderedDict())
 
-    def _make_msg(self, obj, fields):
-        msg_str = []
+    def _make_fields(self, obj, fields):
+        values = OrderedDict()
         for it in fields:
             x = getattr(obj, '{}_str'.format(it), None)
             if not x:
                 x = getattr(obj, it)
             pk = getattr(x, 'pk', None)
             if not pk:
-                x = unicode(x).replace('\\', '\\\\').replace('\"', '\\\"')
-                x = u'\"{}\"'.format(x)
+                values[it] = unicode(x)
             else:
-                x = u':'.join([x.__class__.__name__, unicode(x.pk)])
-            msg_str.append(u'{}: {}'.format(it, x))
-        return u', '.join(msg_str)
+                values[it] = {'otype': x.__class__.__name__, 'oid': x.pk}
+        return values
 
-    def _log(self, user, obj, action, msg):
+    def _log(self, user, obj, action, fields):
+        msg = format_history_fields(fields)
         e = {'uid': user.id, 'action': action, 'otype': type(obj).__name__,
-             'oid': obj.pk}
-        self._logger.info(msg, extra=e)
+             'oid': obj.pk, 'fields': fields}
+        self._info(self._logger, msg, e)
         if self._plain_logger:
             plain_msg = u'{} {} [{}:{}] {}'. \
                 format(user.username, action, e['otype'], e['oid'], msg)
-            self._plain_logger.info(plain_msg)
+            self._info(self._plain_logger, plain_msg)
+
+    def _info(self, logger, msg, extra=None):
+        if not self._queue_size:
+            logger.info(msg, extra=extra)
+        elif logger.isEnabledFor(logging.INFO):
+            record = logger.makeRecord(logger.name, logging.INFO, __file__, 0,
+                                       msg, None, None, extra=extra)
+            self._get_queue().put((logger, record))
+
+    # The queue and its thread are created on first use in each process, as
+    # a process forked after that (i.e. a pre-fork server worker) would get a
+    # copy of the queue but no thread to drain it
+    def _get_queue(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._queue = Queue.Queue(self._queue_size)
+                    thread = threading.Thread(target=self._drain,
+                                              args=(self._queue, ),
+                                              name='HistoryLogger')
+                    thread.daemon = True
+                    thread.start()
+                    self._pid = pid
+        return self._queue
+
+    def _drain(self, queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                queue.task_done()
+                break
+            logger, record = item
+            try:
+                logger.handle(record)
+            finally:
+                queue.task_done()
 
     def unescape(self, txt):
         return txt.replace('\\\"', '\"').replace('\\\\', '\\')
 
 
+# Cache of the parsed history log files, shared by all the HistoryParser
+# instances.  It is bounded to max_items parsed items and max_files files, with
+# the least recently used files being evicted first.  Parsed items are evicted
+# before whole files, starting with the oldest ones so the newest entries of
+# each log stay resident.  An entry is taken out of the cache while a parser
+# has the file open, so it is never shared between two open parsers.
+class HistoryCache(object):
+    def __init__(self, max_items=10000, max_files=16):
+        self.max_items = max_items
+        self.max_files = max_files
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.file_evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(e.data) for e in self._entries.values())
+
+    def get(self, file_name):
+        with self._lock:
+            entry = self._entries.pop(file_name, None)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def put(self, file_name, entry):
+        with self._lock:
+            self._entries.pop(file_name, None)
+            self._entries[file_name] = entry
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _evict(self):
+        n = len(self) - self.max_items
+        for entry in self._entries.values():
+            if n <= 0:
+                break
+            trim = min(n, len(entry.data))
+            entry.trim(len(entry.data) - trim)
+            self.evictions += trim
+            n -= trim
+        while len(self._entries) > self.max_files:
+            file_name, entry = self._entries.popitem(last=False)
+            self.evictions += len(entry.data)
+            self.file_evictions += 1
+
+
+    class Entry(object):
+        def __init__(self, ino, end, head_size, head_crc, data, offsets, pos):
+            self.ino = ino
+            self.end = end
+            self.head_size = head_size
+            self.head_crc = head_crc
+            self.data = data
+            self.offsets = offsets
+            self.pos = pos
+
+        # Only keep the n newest items, the older ones will be parsed again
+        def trim(self, n):
+            if n:
+                self.pos = self.offsets[n - 1]
+            else:
+                self.pos = self.end
+            del self.data[n:]
+            del self.offsets[n:]
+
+
 class HistoryParser(object):
-    cache = dict()
+    cache = HistoryCache()
+    page_size = 50
 
-    def __init__(self, file_name, classes):
+    def __init__(self, file_name, classes, index=False):
         self._file_name = file_name
         self._classes = classes
         self._data = list()
+        self._offsets = list()
+        self._objs = dict()
         self._f = None
+        if index:
+            self._index = HistoryIndex(file_name)
+        else:
+            self._index = None
 
     @property
     def data(self):
         return self._data
 
+    # The log file is memory-mapped and read backwards from the end, so only
+    # the bytes of the newest entries that are actually accessed get read.
+    # As the log is only ever appended to, when it has grown since it was last
+    # opened the new complete lines are read first, on demand as usual, down
+    # to the previous end of the file where the cached items are then used.
+    # Everything is reloaded if the file was truncated or replaced (i.e.
+    # rotated), or if its first bytes have changed.
     def open(self):
-        self._f = open(self._file_name, 'r')
-        self._mtime = os.path.getmtime(self._file_name)
-        cache_mtime, self._data, self._lines = \
-            self.cache.setdefault(self._file_name, (None, list(), list()))
-        if self._mtime != cache_mtime:
+        self._f = open(self._file_name, 'rb')
+        st = os.fstat(self._f.fileno())
+        self._ino = st.st_ino
+        if st.st_size:
+            self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._end = self._mm.rfind(b'\n') + 1
+        else:
+            self._mm = None
+            self._end = 0
+        self._head_size = min(self._end, HistoryIndex.head_size)
+        self._head_crc = self._get_head_crc(self._head_size)
+        entry = self.cache.get(self._file_name)
+        if (entry is None or entry.ino != self._ino
+            or entry.end > self._end
+            or entry.head_crc != self._get_head_crc(entry.head_size)):
+            entry = None
+        self._cached = None
+        self._stop = 0
+        if entry is None:
+            self._data = list()
+            self._offsets = list()
+            self._pos = self._end
+        elif entry.end < self._end:
             self._data = list()
-            self._lines = self._f.readlines()
+            self._offsets = list()
+            self._pos = self._end
+            self._cached = entry
+            self._stop = entry.end
+        else:
+            self._data = entry.data
+            self._offsets = entry.offsets
+            self._pos = entry.pos
+        if self._index is not None:
+            self._index.open()
 
     def close(self):
+        if self._index is not None:
+            self._index.close()
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
         self._f.close()
         self._f = None
-        self.cache[self._file_name] = (self._mtime, self._data, self._lines)
+        # When the previous end of the file hasn't been reached, the cached
+        # items are dropped and will be read again from the file if needed
+        self._cached = None
+        self._stop = 0
+        self.cache.put(self._file_name, HistoryCache.Entry \
+            (self._ino, self._end, self._head_size, self._head_crc,
+             self._data, self._offsets, self._pos))
 
     def __getitem__(self, i):
         if self._f is None:
             raise Exception('History log file not open')
         while len(self._data) < (i + 1):
-            line = self._lines.pop(-1)
-            if not line:
-                raise IndexError
-            pline = HistoryParser.Line(line)
-            self._data.append(HistoryParser.Item \
-                (datetime=self._parse_date_time(pline),
-                 user=self._parse_obj(pline),
-                 obj=self._parse_obj(pline),
-                 action=pline.parse_block(),
-                 args=pline.parse_args()))
+            n = max((i + 1 - len(self._data)), self.page_size)
+            items = list()
+            while len(items) < n:
+                line = self._read_line()
+                if not line:
+                    break
+                items.append(self._parse_line(line))
+                self._offsets.append(self._pos)
+            self._resolve_objs(items)
+            self._data += items
+            if not items:
+                if self._cached is None:
+                    raise IndexError
+                self._use_cached()
         return self._data[i]
 
-    def _parse_date_time(self, pline):
-        block = pline.parse_block()
-        date_ints = []
-        for date_str in block.split(' '):
-            date_ints += [int(x) for x in date_str.split('.')]
-        return datetime.datetime(*date_ints)
+    # Filtered lookups using the sidecar index, newest entries first
+    def filter_obj(self, otype, oid):
+        return self._filter(self._get_index().find_obj(otype, oid))
+
+    def filter_user(self, uid):
+        return self._filter(self._get_index().find_user(uid))
+
+    def filter_dates(self, start=None, end=None):
+        return self._filter(self._get_index().find_dates(start, end))
 
-    def _parse_obj(self, pline):
-        block = pline.parse_block()
-        obj_class, obj_pk = block.split(':')
+    def _get_index(self):
+        if self._f is None:
+            raise Exception('History log file not open')
+        if self._index is None:
+            raise Exception('History log index not enabled')
+        return self._index
+
+    def _filter(self, offsets):
+        items = list()
+        if self._mm is None:
+            return items
+        size = len(self._mm)
+        for offset in offsets:
+            if offset >= size: # appended after the file was opened
+                continue
+            end = self._mm.find(b'\n', offset)
+            if end == -1:
+                continue
+            items.append(self._parse_line(self._mm[offset:end]))
+        self._resolve_objs(items)
+        return items
+
+    # JSON lines are decoded in one go, other lines use cams.history_format
+    def _parse_line(self, line):
+        if line.startswith(b'{'):
+            d = json.loads(line, object_pairs_hook=OrderedDict)
+            return HistoryParser.Item \
+                (datetime=datetime.datetime.fromtimestamp(d['t']),
+                 user=self._get_ref('User', d['uid']),
+                 obj=self._get_ref(d['otype'], d['oid']),
+                 action=d['action'],
+                 args=format_history_fields(d['fields']),
+                 fields=d['fields'])
+        pline = HistoryParser.Line(line)
+        return HistoryParser.Item(datetime=pline.parse_date_time(),
+                                  user=self._get_ref(*pline.parse_ref()),
+                                  obj=self._get_ref(*pline.parse_ref()),
+                                  action=pline.parse_block(),
+                                  args=pline.parse_args(),
+                                  fields=None)
+
+    # Same check as HistoryIndex to detect when a file was truncated and
+    # written again, i.e. rotated with copytruncate
+    def _get_head_crc(self, size):
+        if self._mm is None:
+            return zlib.crc32(b'')
+        return zlib.crc32(self._mm[:size])
+
+    def _read_line(self):
+        line = ''
+        while not line and self._pos > self._stop:
+            line, self._pos = self._read_line_before(self._stop, self._pos)
+        return line
+
+    # Return the last line between start and end, and its start position
+    def _read_line_before(self, start, end):
+        line_start = max((self._mm.rfind(b'\n', start, end - 1) + 1), start)
+        return self._mm[line_start:end].strip(), line_start
+
+    # Continue with the cached items once all the new lines have been read
+    def _use_cached(self):
+        self._data += self._cached.data
+        self._offsets += self._cached.offsets
+        self._pos = self._cached.pos
+        self._cached = None
+        self._stop = 0
+
+    # Objects are first parsed as (class, pk) references, then resolved with
+    # one query per class for a whole batch of items and kept in self._objs
+    def _get_ref(self, obj_class, obj_pk):
         cls = self._classes.get(obj_class)
         if not cls:
             return None
-        try:
-            return cls.objects.get(pk=obj_pk)
-        except cls.DoesNotExist:
-            return None
+        return (cls, obj_pk)
+
+    def _resolve_objs(self, items):
+        missing = dict()
+        for it in items:
+            for ref in (it.user, it.obj):
+                if ref is not None and ref not in self._objs:
+                    missing.setdefault(ref[0], set()).add(ref[1])
+        for cls, pks in missing.items():
+            objs = cls.objects.in_bulk(list(pks))
+            for pk in pks:
+                self._objs[(cls, pk)] = objs.get(pk)
+        for it in items:
+            it.user = self._objs.get(it.user)
+            it.obj = self._objs.get(it.obj)
 
 
     class Line(object):
@@ -268,6 +650,53 @@ class HistoryParser(object):
         def parse_args(self):
             return self._line[self._pos:].strip()
 
+        def parse_date_time(self):
+            block = self.parse_block()
+            date_ints = []
+            for date_str in block.split(' '):
+                date_ints += [int(x) for x in date_str.split('.')]
+            return datetime.datetime(*date_ints)
+
+        def parse_ref(self):
+            obj_class, obj_pk = self.parse_block().split(':')
+            return obj_class, int(obj_pk)
+
+        # Parse the arguments as formatted by format_history_fields()
+        def parse_fields(self):
+            try:
+                return self._parse_fields(self.parse_args())
+            except (IndexError, ValueError):
+                raise Exception("Failed to parse fields")
+
+        def _parse_fields(self, args):
+            fields = OrderedDict()
+            i = 0
+            while i < len(args):
+                j = args.index(': ', i)
+                key = args[i:j]
+                i = j + 2
+                if args[i] == '"':
+                    value = []
+                    i += 1
+                    while args[i] != '"':
+                        if args[i] == '\\':
+                            i += 1
+                        value.append(args[i])
+                        i += 1
+                    value = ''.join(value)
+                    i += 1
+                else:
+                    j = args.find(', ', i)
+                    if j == -1:
+                        j = len(args)
+                    otype, oid = args[i:j].split(':')
+                    value = {'otype': otype, 'oid': int(oid)}
+                    i = j
+                fields[key] = value
+                if args.startswith(', ', i):
+                    i += 2
+            return fields
+
 
     class Item(object):
         def __init__(self, **kw):
@@ -275,6 +704,122 @@ class HistoryParser(object):
                 setattr(self, k, v)
 
 
+# Sidecar index of a history log file, stored in an SQLite database next to the
+# log (log file name + '.idx') so it can be shared between processes.  It maps
+# the offset of each line to its user id, object type and id, and day.  Only
+# the lines appended since the last update get indexed, and the index is reset
+# if the log file was truncated or rotated.
+class HistoryIndex(object):
+    schema = """
+CREATE TABLE IF NOT EXISTS state (
+    id INTEGER PRIMARY KEY, pos INTEGER, head_size INTEGER, head_crc INTEGER);
+CREATE TABLE IF NOT EXISTS entries (
+    offset INTEGER PRIMARY KEY, uid INTEGER, otype TEXT, oid INTEGER,
+    day TEXT);
+CREATE INDEX IF NOT EXISTS entries_obj ON entries (otype, oid);
+CREATE INDEX IF NOT EXISTS entries_uid ON entries (uid);
+CREATE INDEX IF NOT EXISTS entries_day ON entries (day);
+"""
+    head_size = 256
+    batch_size = 1000
+
+    def __init__(self, log_file_name, file_name=None):
+        self._log_file_name = log_file_name
+        if file_name is None:
+            file_name = log_file_name + '.idx'
+        self._file_name = file_name
+        self._db = None
+
+    def open(self):
+        self._db = sqlite3.connect(self._file_name, timeout=30,
+                                   isolation_level=None)
+        self._db.executescript(self.schema)
+
+    def close(self):
+        self._db.close()
+        self._db = None
+
+    def update(self):
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            self._update()
+        except:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    def find_obj(self, otype, oid):
+        return self._find('otype = ? AND oid = ?', (otype, oid))
+
+    def find_user(self, uid):
+        return self._find('uid = ?', (uid, ))
+
+    def find_dates(self, start=None, end=None):
+        where = ['1']
+        args = []
+        if start is not None:
+            where.append('day >= ?')
+            args.append(start.isoformat())
+        if end is not None:
+            where.append('day <= ?')
+            args.append(end.isoformat())
+        return self._find(' AND '.join(where), args)
+
+    def _find(self, where, args):
+        self.update()
+        q = 'SELECT offset FROM entries WHERE {} ORDER BY offset DESC'. \
+            format(where)
+        return [row[0] for row in self._db.execute(q, args)]
+
+    def _update(self):
+        row = self._db.execute('SELECT pos, head_size, head_crc FROM state '
+                               'WHERE id = 0').fetchone()
+        if row is None:
+            pos, head_size, head_crc = (0, 0, 0)
+        else:
+            pos, head_size, head_crc = row
+        with open(self._log_file_name, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < pos or zlib.crc32(f.read(head_size)) != head_crc:
+                self._db.execute('DELETE FROM entries')
+                pos = 0
+            f.seek(0)
+            head = f.read(self.head_size)
+            f.seek(pos)
+            rows = list()
+            for line in f:
+                if not line.endswith(b'\n'): # still being written
+                    break
+                row = self._parse_line(line)
+                if row is not None:
+                    rows.append((pos, ) + row)
+                    if len(rows) == self.batch_size:
+                        self._insert(rows)
+                pos += len(line)
+            self._insert(rows)
+        self._db.execute('INSERT OR REPLACE INTO state VALUES (0, ?, ?, ?)',
+                         (pos, len(head), zlib.crc32(head)))
+
+    def _insert(self, rows):
+        self._db.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, ?)',
+                             rows)
+        del rows[:]
+
+    def _parse_line(self, line):
+        try:
+            if line.startswith(b'{'):
+                d = json.loads(line)
+                day = datetime.date.fromtimestamp(d['t']).isoformat()
+                return (d['uid'], d['otype'], d['oid'], day)
+            pline = HistoryParser.Line(line)
+            day = pline.parse_block().split(' ')[0].replace('.', '-')
+            uid = pline.parse_ref()[1]
+            otype, oid = pline.parse_ref()
+            return (uid, otype, oid, day)
+        except Exception: # ignore lines not in the history format
+            return None
+
+
 
 # -----------------------------------------------------------------------------
 # Helpers
@@ -0,0 +1,44 @@
+# CAMS - management/commands/cams_basic_names.py
+#
+# Copyright (C) 2009, 2010, 2011. 2012, 2013
+# Guillaume Tucker <guillaume@mangoz.org>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from cams.models import Contactable
+
+class Command(BaseCommand):
+    help = "Recompute the basic names of the address book entries"
+    option_list = BaseCommand.option_list + (
+        make_option('--check', action='store_true', dest='check',
+                    default=False,
+                    help="Only report the mismatches, do not fix them"),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=1000,
+                    help="Number of entries to process in each batch"),
+        )
+
+    def handle(self, *args, **options):
+        check = options['check']
+        mismatches = Contactable.update_basic_names(check,
+                                                    options['batch_size'])
+        for pk, basic_name, expected in mismatches:
+            self.stdout.write(u'{}: "{}" -> "{}"'.format
+                              (pk, basic_name, expected))
+        if check:
+            self.stdout.write('{} mismatches found'.format(len(mismatches)))
+        else:
+            self.stdout.write('{} entries fixed'.format(len(mismatches)))
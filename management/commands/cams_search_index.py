@@ -0,0 +1,34 @@
+# CAMS - management/commands/cams_search_index.py
+#
+# Copyright (C) 2009, 2010, 2011. 2012, 2013
+# Guillaume Tucker <guillaume@mangoz.org>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from cams.search import contactable_search
+
+class Command(BaseCommand):
+    help = "Create and rebuild the address book search index"
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=1000,
+                    help="Number of entries to process in each batch"),
+        )
+
+    def handle(self, *args, **options):
+        contactable_search.install()
+        n = contactable_search.rebuild(options['batch_size'])
+        self.stdout.write('{} entries indexed'.format(n))
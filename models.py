@@ -17,16 +17,48 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from datetime import datetime, date
-from django.db import models
+from django.db import models, connection, transaction
 from django.db.models import (CharField, TextField, EmailField, URLField,
                               IntegerField, BooleanField,
                               PositiveSmallIntegerField, DecimalField,
                               DateField, TimeField, DateTimeField,
                               ForeignKey, OneToOneField, ManyToManyField)
+from django.db.models import Count
 from django.db.models.query import Q
+from django.db.models.signals import post_save, post_delete
 from django.contrib.auth.models import User
 from libcams import get_first_words, get_obj_address
 
+# Set a field to a different value for each primary key with CASE updates
+def _update_by_pk(model, field_name, values, chunk_size=250):
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    pk = qn(model._meta.pk.column)
+    column = qn(model._meta.get_field(field_name).column)
+    cursor = connection.cursor()
+    # A CASE with only NULL values has no type with PostgreSQL, which then
+    # can't assign it to non-text columns so they are set separately
+    nulls = list(obj_id for obj_id, value in values.items() if value is None)
+    for i in range(0, len(nulls), chunk_size):
+        chunk = nulls[i:(i + chunk_size)]
+        sql = 'UPDATE {table} SET {column} = NULL ' \
+            'WHERE {pk} IN ({ids})'.format \
+            (table=table, pk=pk, column=column,
+             ids=', '.join(['%s'] * len(chunk)))
+        cursor.execute(sql, chunk)
+    values = list(item for item in values.items() if item[1] is not None)
+    for i in range(0, len(values), chunk_size):
+        chunk = values[i:(i + chunk_size)]
+        sql = 'UPDATE {table} SET {column} = CASE {pk} {cases} END ' \
+            'WHERE {pk} IN ({ids})'.format \
+            (table=table, pk=pk, column=column,
+             cases=' '.join(['WHEN %s THEN %s'] * len(chunk)),
+             ids=', '.join(['%s'] * len(chunk)))
+        args = [x for item in chunk for x in item]
+        args += [obj_id for obj_id, value in chunk]
+        cursor.execute(sql, args)
+
+
 class Record(models.Model):
     NEW = 0
     ACTIVE = 1
@@ -62,6 +94,17 @@ class PinBoard(models.Model):
     def __unicode__(self):
         return self.name
 
+    # Pin down all the current groups with their roles onto the board, which
+    # then gets locked, and return the numbers of pins and rows copied
+    def snapshot(self, lock=True):
+        with transaction.atomic():
+            board = PinBoard.objects.select_for_update().get(pk=self.pk)
+            counts = Group.pin_down_all(board)
+            if lock:
+                self.status = PinBoard.LOCKED
+                self.save()
+        return counts
+
 
 class Pin(models.Model):
     board = ForeignKey(PinBoard, blank=True, null=True,
@@ -90,54 +133,166 @@ class Pin(models.Model):
         return False
 
     def get_versions(self):
-        vlist = list()
-        p = self
-        while p is not None:
-            vlist.append(p)
-            p = p.parent
-        del(vlist[0])
-        p = self
-        while p is not None:
-            vlist.insert(0, p)
-            res = p.__class__.objects.filter(parent=p)
-            if len(res) > 0:
-                p = res[0]
-            else:
-                p = None
-        return vlist
+        return self.get_version_chains([self])[self.pk]
 
     def get_current_version(self):
         return self.get_versions()[0]
 
     def get_version_for_board(self, board):
-        for p in self.get_versions():
-            if p.board == board:
-                return p
-        return None
+        return self.get_versions_for_board([self], board)[self.pk]
+
+    # Get the version chains of a list of pins (newest version first) with one
+    # recursive query to find the ids of all the versions and another one to
+    # load them, regardless of the number of pins and versions.
+    @classmethod
+    def get_version_chains(cls, pins):
+        pins = dict((p.pk, p) for p in pins)
+        if not pins:
+            return dict()
+        table, pk, parent = cls._get_sql_names()
+        pins_in = ', '.join(['%s'] * len(pins))
+        sql = """
+WITH RECURSIVE
+  up(origin, id, parent, depth) AS (
+    SELECT {pk}, {pk}, {parent}, 0 FROM {table} WHERE {pk} IN ({pins_in})
+    UNION ALL
+    SELECT up.origin, t.{pk}, t.{parent}, up.depth + 1
+    FROM {table} t JOIN up ON t.{pk} = up.parent),
+  down(origin, id, depth) AS (
+    SELECT {pk}, {pk}, 0 FROM {table} WHERE {pk} IN ({pins_in})
+    UNION ALL
+    SELECT down.origin, t.{pk}, down.depth - 1
+    FROM {table} t JOIN down ON t.{parent} = down.id)
+SELECT origin, id, depth FROM up
+UNION SELECT origin, id, depth FROM down
+ORDER BY origin, depth, id
+""".format(pk=pk, parent=parent, table=table, pins_in=pins_in)
+        cursor = connection.cursor()
+        cursor.execute(sql, list(pins.keys()) * 2)
+        chains = dict()
+        for origin, pin_id, depth in cursor.fetchall():
+            chain = chains.setdefault(origin, list())
+            # only follow the first child like when walking the versions
+            if not chain or chain[-1][0] != depth:
+                chain.append((depth, pin_id))
+        objs = cls.objects.select_related('board').in_bulk \
+            (set(pin_id for c in chains.values() for d, pin_id in c))
+        objs.update(pins)
+        return dict((origin, [objs[pin_id] for d, pin_id in c])
+                    for origin, c in chains.items())
+
+    @classmethod
+    def get_current_versions(cls, pins):
+        return dict((pk, versions[0]) for pk, versions in
+                    cls.get_version_chains(pins).items())
 
+    @classmethod
+    def get_versions_for_board(cls, pins, board):
+        board_id = board.pk if board is not None else None
+        board_versions = dict()
+        for pk, versions in cls.get_version_chains(pins).items():
+            board_versions[pk] = None
+            for p in versions:
+                if p.board_id == board_id:
+                    board_versions[pk] = p
+                    break
+        return board_versions
+
+    # The copy is made in a transaction so it can't be left half-done
     def pin_down(self, board):
-        pinned = self.__class__.objects.get(pk=self.pk)
-        pinned.pk = None
-        pinned.board = board
-        pinned.save()
-        pinned._pin_down_deep_copy(self)
-        self.parent = pinned
-        self.save()
+        with transaction.atomic():
+            pinned = self.__class__.objects.get(pk=self.pk)
+            pinned.pk = None
+            pinned.board = board
+            pinned.save()
+            pinned._pin_down_deep_copy(self)
+            self.parent = pinned
+            self.save()
         return pinned
 
     def _pin_down_deep_copy(self, current):
         pass
 
+    # Pin down all the current entries which are not already on the board with
+    # a fixed number of bulk queries.  The copies are first created as children
+    # of the current entries in order to match them, then the parents are
+    # swapped so each copy becomes the parent of its current entry like with
+    # pin_down().
+    @classmethod
+    def pin_down_all(cls, board):
+        if board.status != PinBoard.OPEN:
+            raise Exception('Pin board not open')
+        with transaction.atomic():
+            current = list(cls.objects.filter(board__isnull=True))
+            chains = cls.get_version_chains(current)
+            pins = list()
+            for p in current:
+                for v in chains[p.pk]:
+                    if v.board_id == board.pk:
+                        break
+                else:
+                    pins.append(p)
+            parents = dict((p.pk, p.parent_id) for p in pins)
+            for p in pins:
+                p.parent_id = p.pk
+                p.pk = None
+                p.board = board
+            cls.objects.bulk_create(pins)
+            copies = cls.objects.filter(board=board,
+                                        parent__in=list(parents))
+            copies = dict(copies.values_list('parent', 'pk'))
+            rows = cls._pin_down_deep_copy_all(copies)
+            new_parents = dict(copies)
+            new_parents.update((c, parents[p]) for p, c in copies.items())
+            _update_by_pk(cls, 'parent', new_parents)
+        _board_registry.clear()
+        return {'pins': len(copies), 'skipped': len(current) - len(copies),
+                'rows': len(copies) + rows}
+
+    # Copy the related data of the current entries (copies maps the current
+    # entry ids to their copies ids) and return the number of rows copied
+    @classmethod
+    def _pin_down_deep_copy_all(cls, copies):
+        return 0
+
+    @classmethod
+    def _get_sql_names(cls):
+        qn = connection.ops.quote_name
+        return (qn(cls._meta.db_table), qn(cls._meta.pk.column),
+                qn(cls._meta.get_field('parent').column))
+
     @classmethod
     def get_boards(cls):
-        boards = set()
-        for g in cls.objects.all():
-            boards.add(g.board)
-        return boards
+        return set(cls.get_board_counts().keys())
+
+    # Number of pins on each board (None for the current ones), kept in a
+    # per-process registry until a PinBoard or a Pin is saved or deleted
+    @classmethod
+    def get_board_counts(cls):
+        counts = _board_registry.get(cls)
+        if counts is None:
+            rows = cls.objects.order_by().values('board'). \
+                annotate(n=Count('pk'))
+            rows = dict((r['board'], r['n']) for r in rows)
+            boards = PinBoard.objects.in_bulk([b for b in rows if b])
+            boards[None] = None
+            counts = dict((boards[b], n) for b, n in rows.items())
+            _board_registry[cls] = counts
+        return dict(counts)
 
     class Meta(object):
         abstract = True
 
+
+_board_registry = dict()
+
+def _clear_board_registry(sender, **kwargs):
+    if issubclass(sender, (Pin, PinBoard)):
+        _board_registry.clear()
+
+post_save.connect(_clear_board_registry)
+post_delete.connect(_clear_board_registry)
+
 # -----------------------------------------------------------------------------
 # address book
 
@@ -152,49 +307,143 @@ class Contactable(Record):
     # ToDo: rename to something else as `type' is a built-in function name
     type = PositiveSmallIntegerField(choices=xtype, editable=False)
     basic_name = CharField(max_length=255)
+    primary_contact = ForeignKey('Contact', blank=True, null=True,
+                                 editable=False, related_name='+',
+                                 on_delete=models.SET_NULL)
+
+    def __init__(self, *args, **kwargs):
+        super(Contactable, self).__init__(*args, **kwargs)
+        self._saved_status = self.__dict__.get('status')
 
     def __unicode__(self):
         return self.subobj.__unicode__()
 
     def save(self, *args, **kwargs):
         self._update_basic_name();
+        # A new entry has no members yet to propagate its status to
+        status_changed = not self._state.adding and \
+            self.status != self._saved_status
+        # The primary contact is maintained by update_primary_contacts() so
+        # an existing row is saved without it to not write back a stale value
+        if not (self._state.adding or args or kwargs.get('force_insert') or
+                ('update_fields' in kwargs)):
+            kwargs['update_fields'] = list(
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name != 'primary_contact')
         super(Contactable, self).save(*args, **kwargs)
-        members = getattr(self, 'members_list', None)
-        if members:
-            for m in members.all():
-                m.update_status()
+        self._saved_status = self.status
+        if status_changed and \
+                self.type in (Contactable.PERSON, Contactable.ORGANISATION):
+            Member.propagate_status(Contactable.objects.filter(pk=self.pk))
+            # The members were indexed by post_save before their status got
+            # propagated
+            members = Member.objects.filter(Q(person=self.pk) |
+                                            Q(organisation=self.pk))
+            cams.search.contactable_autocomplete.update \
+                (members.values_list('pk', flat=True))
+
+    # Set the status of all the entries in a queryset of people and/or
+    # organisations and propagate it to their members
+    @classmethod
+    def set_status(cls, contactables, status):
+        with transaction.atomic():
+            ids = list(contactables.values_list('pk', flat=True))
+            contactables = Contactable.objects.filter(pk__in=ids)
+            contactables.update(status=status)
+            Member.propagate_status(contactables)
+            members = Member.objects.filter(Q(person__in=ids) |
+                                            Q(organisation__in=ids))
+            ids += members.values_list('pk', flat=True)
+        cams.search.contactable_autocomplete.update(ids)
 
     def _update_basic_name(self):
         self.basic_name = self.__unicode__()
 
+    # Recompute the basic names of all the people, organisations and members
+    # in batches and only update the ones which are different, unless check
+    # is True in which case nothing gets written.  A list of (pk, basic_name,
+    # expected) tuples is returned with all the mismatches found.
+    @classmethod
+    def update_basic_names(cls, check=False, batch_size=1000):
+        person_fields = ('first_name', 'middle_name', 'last_name')
+        member_fields = tuple('person__' + f for f in person_fields)
+        mismatches = list()
+        for model, fields, make_name in \
+                ((Person, person_fields, Person.make_name),
+                 (Organisation, ('name', ), lambda name: name),
+                 (Member, member_fields, Person.make_name)):
+            last_pk = 0
+            while True:
+                rows = model.objects.filter(pk__gt=last_pk).order_by('pk')
+                rows = list(rows.values_list('pk', 'basic_name', *fields)
+                            [:batch_size])
+                if not rows:
+                    break
+                names = dict()
+                for row in rows:
+                    name = make_name(*row[2:])
+                    if row[1] != name:
+                        names[row[0]] = name
+                        mismatches.append((row[0], row[1], name))
+                if names and not check:
+                    _update_by_pk(Contactable, 'basic_name', names)
+                last_pk = rows[-1][0]
+        return mismatches
+
+    # The groups are filtered here rather than in the query when group_set
+    # was prefetched, as done in the admin change lists
     @property
     def current_groups(self):
-        groups_str = ''
-        if self.group_set:
-            groups = self.group_set.filter(board__isnull=True)
-            for g in groups:
-                if groups_str:
-                    groups_str += ', '
-                groups_str += g.name
-
-        return groups_str
+        group_set = self.group_set
+        if group_set.prefetch_cache_name in \
+                getattr(self, '_prefetched_objects_cache', {}):
+            groups = (g for g in group_set.all() if g.board_id is None)
+        else:
+            groups = group_set.filter(board__isnull=True)
+        return ', '.join(g.name for g in groups)
 
     # ToDo: create special tag instead ?
     @property
     def contact(self):
-        if self.contact_set.count():
-            return self.contact_set.all()[0]
+        c = self.primary_contact
+        if c is not None and c.obj_id == self.pk:
+            return c
         else:
             return None
 
     @property
     def contacts(self):
-        c = self.contact_set.all()
-        if c.count() == 0:
-            m = self.members_list.all()
-            if m.count() > 0:
-                c = m[0].contact_set.all()
-        return c
+        if self.primary_contact_id is None:
+            return Contact.objects.none()
+        return Contact.objects.filter(obj__contact=self.primary_contact_id)
+
+    # The primary contact is the first contact of an entry, or the first
+    # contact of its first member if it has no contacts.  It is updated when
+    # a Contact or a Member is saved or deleted.  The cams_primary_contacts
+    # command uses this to initialise it for all the existing entries.
+    @classmethod
+    def update_primary_contacts(cls, pks):
+        pks = set(pks)
+        primary = dict()
+        contacts = Contact.objects.filter(obj__in=pks).order_by('-pk')
+        for obj_id, contact_id in contacts.values_list('obj', 'pk'):
+            primary[obj_id] = contact_id
+        missing = pks.difference(primary)
+        if missing:
+            members = Member.objects.filter(Q(person__in=missing) |
+                                            Q(organisation__in=missing))
+            members = members.order_by('-basic_name', '-pk')
+            first_member = dict()
+            for member_id, person_id, org_id in \
+                    members.values_list('pk', 'person', 'organisation'):
+                first_member[person_id] = member_id
+                first_member[org_id] = member_id
+            contacts = Contact.objects.filter \
+                (obj__in=set(first_member.values())).order_by('-pk')
+            member_contacts = dict(contacts.values_list('obj', 'pk'))
+            for pk in missing:
+                primary[pk] = member_contacts.get(first_member.get(pk))
+        _update_by_pk(Contactable, 'primary_contact', primary)
 
     @property
     def type_str(self):
@@ -202,6 +451,9 @@ class Contactable(Record):
 
     @property
     def subobj(self):
+        subobj = getattr(self, '_subobj', None)
+        if subobj is not None:
+            return subobj
         if self.type == Contactable.PERSON:
             return self.person
         elif self.type == Contactable.ORGANISATION:
@@ -209,6 +461,37 @@ class Contactable(Record):
         elif self.type == Contactable.MEMBER:
             return self.member
 
+    # Load the sub-objects of a list or queryset of contactables with one
+    # query per type, members coming with their person and organisation.  The
+    # sub-objects are also cached as the person, organisation or member of
+    # each contactable, so these and subobj don't need any further query.
+    @classmethod
+    def load_subobjs(cls, contactables):
+        contactables = list(contactables)
+        subobj_types = {
+            Contactable.PERSON: (Person, 'person', []),
+            Contactable.ORGANISATION: (Organisation, 'organisation', []),
+            Contactable.MEMBER: (Member, 'member', ['person', 'organisation']),
+            }
+        pks = dict()
+        subobjs = dict()
+        for c in contactables:
+            if isinstance(c, subobj_types[c.type][0]):
+                subobjs[c.pk] = c
+            else:
+                pks.setdefault(c.type, list()).append(c.pk)
+        for subobj_type, type_pks in pks.items():
+            model, name, related = subobj_types[subobj_type]
+            qs = model.objects.select_related(*related)
+            subobjs.update(qs.in_bulk(type_pks))
+        for c in contactables:
+            subobj = subobjs.get(c.pk)
+            c._subobj = subobj
+            if subobj is not None and subobj is not c:
+                name = subobj_types[c.type][1]
+                setattr(c, getattr(Contactable, name).cache_name, subobj)
+        return contactables
+
     @property
     def current_roles(self):
         roles = Role.objects.filter(contactable=self)
@@ -250,10 +533,15 @@ class Person(Contactable):
                             "People who can be contacted instead.")
 
     def __unicode__(self):
-        name = self.first_name
-        if self.middle_name:
-            name += ' ' + self.middle_name
-        return name + ' ' + self.last_name
+        return Person.make_name(self.first_name, self.middle_name,
+                                self.last_name)
+
+    @classmethod
+    def make_name(cls, first_name, middle_name, last_name):
+        name = first_name
+        if middle_name:
+            name += ' ' + middle_name
+        return name + ' ' + last_name
 
     def save(self, *args, **kwargs):
         self.type = Contactable.PERSON
@@ -341,6 +629,24 @@ class Member(Contactable):
         if self.status != old_status:
             self.save()
 
+    # Same rules as update_status() applied with a few UPDATE statements to
+    # all the members of a queryset of people and/or organisations
+    @classmethod
+    def propagate_status(cls, contactables):
+        ids = contactables.order_by().values('pk')
+        members = cls.objects.filter(Q(person__in=ids) |
+                                     Q(organisation__in=ids))
+        is_new = Q(person__status=Record.NEW) | \
+            Q(organisation__status=Record.NEW)
+        is_disabled = Q(person__status=Record.DISABLED) | \
+            Q(organisation__status=Record.DISABLED)
+        members.filter(is_new).exclude(status=Record.NEW). \
+            update(status=Record.NEW)
+        members.exclude(is_new).filter(is_disabled). \
+            exclude(status=Record.DISABLED).update(status=Record.DISABLED)
+        members.exclude(is_new).exclude(is_disabled). \
+            exclude(status=Record.ACTIVE).update(status=Record.ACTIVE)
+
     @property
     def name_nn(self):
         return self.person.name_nn
@@ -395,6 +701,33 @@ class Contact(Record):
     class Meta(object):
         db_table = 'cams_abook_contact'
 
+
+def _update_contact_primary(sender, instance, **kwargs):
+    pks = set([instance.obj_id])
+    members = Member.objects.filter(pk=instance.obj_id)
+    for person_id, org_id in members.values_list('person', 'organisation'):
+        pks.update([person_id, org_id])
+    Contactable.update_primary_contacts(pks)
+
+def _update_member_primary(sender, instance, **kwargs):
+    Contactable.update_primary_contacts([instance.person_id,
+                                         instance.organisation_id])
+
+post_save.connect(_update_contact_primary, sender=Contact)
+post_delete.connect(_update_contact_primary, sender=Contact)
+post_save.connect(_update_member_primary, sender=Member)
+post_delete.connect(_update_member_primary, sender=Member)
+
+
+# Search index for the address book entries, see cams.search
+class ContactableIndex(models.Model):
+    contactable = OneToOneField(Contactable, primary_key=True,
+                                related_name='search_index')
+    text = TextField()
+
+    class Meta(object):
+        db_table = 'cams_abook_search'
+
 # -----------------------------------------------------------------------------
 # management
 
@@ -402,7 +735,7 @@ class Contact(Record):
 class Fair(models.Model):
     date = DateField(unique=True)
     description = TextField(blank=True)
-    current = BooleanField(help_text=
+    current = BooleanField(default=False, help_text=
                            "There must be one and only one current fair.")
 
     def __unicode__(self):
@@ -412,35 +745,91 @@ class Fair(models.Model):
     def short_desc(self):
         return get_first_words(self.description)
 
+    # The current fair rows are locked so concurrent saves are serialised and
+    # can't leave zero or two current fairs
     def save(self, *args, **kwargs):
-        if self.current == True:
-            super(Fair, self).save(*args, **kwargs)
-
-            for f in Fair.objects.all():
-                if f.current == True and f != self:
-                    f.current = False
-                    f.save()
-        else:
-            found = False
-
-            for f in Fair.objects.all():
-                if f.current == True and f != self:
-                    found = True
-                    break
-
-            if found == False:
+        with transaction.atomic():
+            others = Fair.objects.filter(current=True)
+            if self.pk is not None:
+                others = others.exclude(pk=self.pk)
+            found = list(others.select_for_update().values_list('pk'))
+            if not found:
                 self.current = True
-
             super(Fair, self).save(*args, **kwargs)
-
+            if self.current:
+                Fair.objects.filter(current=True).exclude(pk=self.pk). \
+                    update(current=False)
+        # Only once committed, or another thread could cache the old fair again
+        _fair_cache.clear()
+
+    def delete(self, *args, **kwargs):
+        super(Fair, self).delete(*args, **kwargs)
+        _fair_cache.clear()
+
+    # Copy all the events of this fair and their actors into another fair with
+    # bulk inserts, shifting the dates by the difference between the two fairs
+    # dates.  The new events are first created with the original ones as
+    # master to be able to match them, then the master of the copies of
+    # events which had one is set to that same master.  The numbers of events
+    # and actors copied are returned, or just counted with dry_run=True.
+    def clone_programme(self, fair, dry_run=False):
+        events = Event.objects.filter(fair=self)
+        actors = Actor.objects.filter(event__fair=self)
+        if dry_run:
+            return {'events': events.count(), 'actors': actors.count()}
+        offset = fair.date - self.date
+        with transaction.atomic():
+            existing = Event.objects.filter(fair=fair)
+            existing = set(existing.values_list('pk', flat=True))
+            events = list(events)
+            masters = dict()
+            for e in events:
+                if e.master_id is not None:
+                    masters[e.pk] = e.master_id
+                e.master_id = e.pk
+                e.pk = None
+                e.fair = fair
+                e.date += offset
+                if e.end_date is not None:
+                    e.end_date += offset
+            Event.objects.bulk_create(events)
+            clones = Event.objects.filter(fair=fair, master__fair=self)
+            clones = dict((master_id, pk) for pk, master_id in
+                          clones.values_list('pk', 'master')
+                          if pk not in existing)
+            masters = dict((clones[pk], master_id) for pk, master_id in
+                           masters.items())
+            _update_by_pk(Event, 'master', masters)
+            actors = [Actor(person_id=person_id, event_id=clones[event_id],
+                            role=role, status=status) for
+                      person_id, event_id, role, status in
+                      actors.values_list('person', 'event', 'role', 'status')]
+            Actor.objects.bulk_create(actors)
+        return {'events': len(events), 'actors': len(actors)}
+
+    # The current fair is kept in a per-process cache until a Fair is saved or
+    # deleted
     @classmethod
     def get_current(cls):
-        return cls.objects.filter(current=True)[0]
+        fair = _fair_cache.get('current')
+        if fair is None:
+            fair = cls.objects.filter(current=True)[0]
+            _fair_cache['current'] = fair
+        return fair
 
     class Meta(object):
         ordering = ['-date']
 
 
+_fair_cache = dict()
+
+# Fairs deleted in bulk from a queryset don't go through Fair.delete()
+def _clear_fair_cache(sender, **kwargs):
+    _fair_cache.clear()
+
+post_delete.connect(_clear_fair_cache, sender=Fair)
+
+
 class Player(Record):
     person = OneToOneField(Person)
     user = OneToOneField(User)
@@ -505,6 +894,20 @@ class Event(Item):
             return ev[0]
         return None
 
+    # Same as get_for_fair for a list of event ids with a single query,
+    # returning a dictionary with the event (or None) for each id
+    @classmethod
+    def get_many_for_fair(cls, event_ids, fair):
+        event_ids = set(int(i) for i in event_ids)
+        ev = cls.objects.filter(Q(pk__in=event_ids) | Q(master__in=event_ids))
+        ev = ev.filter(fair=fair).order_by('name', 'pk')
+        events = dict((i, None) for i in event_ids)
+        for e in ev:
+            for i in (e.pk, e.master_id):
+                if i in events and events[i] is None:
+                    events[i] = e
+        return events
+
     class Meta(object):
         ordering = ['name']
         permissions = (
@@ -541,10 +944,19 @@ class Group(Pin):
         return self.format_pin_name(self.name)
 
     def _pin_down_deep_copy(self, current):
-        for r in Role.objects.filter(group=current):
+        roles = list(Role.objects.filter(group=current))
+        for r in roles:
             r.pk = None
             r.group = self
-            r.save()
+        Role.objects.bulk_create(roles)
+
+    @classmethod
+    def _pin_down_deep_copy_all(cls, copies):
+        roles = Role.objects.filter(group__in=list(copies))
+        roles = [Role(contactable_id=c, group_id=copies[g], role=r) for
+                 c, g, r in roles.values_list('contactable', 'group', 'role')]
+        Role.objects.bulk_create(roles)
+        return len(roles)
 
     class Meta(object):
         ordering = ['name']
@@ -572,13 +984,8 @@ class Comment(Record):
     author = ForeignKey(Player)
     text = TextField()
 
+    # ToDo: add the author name ?
     def __unicode__(self):
-        try:
-            p = Player.objects.get(user=self.author)
-            name = p.person.__unicode__()
-        except Player.DoesNotExist:
-            name = self.author.__unicode__()
-        # ToDo: what about name ?
         return get_first_words(self.text)
 
     class Meta(object):
@@ -671,3 +1078,7 @@ class Invoice(models.Model):
             ('invoices_add', "Can add invoices"),
             ('invoices_delete', "Can delete invoices"),
         )
+
+# The search module connects its signal handlers to the models above and
+# imports them, so it is imported as a whole and only used lazily here
+import cams.search
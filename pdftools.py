@@ -28,6 +28,14 @@ from reportlab.lib.enums import TA_LEFT
 from reportlab.lib import colors
 
 def append_org_form(org, flow, page_size):
+    append_orgs_forms([org], flow, page_size)
+
+# Append the forms of all the organisations to the flow, with the styles built
+# only once and all the organisation, member and person contacts loaded with a
+# few queries.  The members are listed by name and the first contact of each
+# entry is the one with the lowest pk.
+def append_orgs_forms(orgs, flow, page_size):
+    orgs = list(orgs)
     styles = getSampleStyleSheet()
     width, height = page_size
     border = inch/2
@@ -36,25 +44,11 @@ def append_org_form(org, flow, page_size):
 
     title_style = deepcopy(styles["Normal"])
     title_style.fontSize = 13
-    title = Paragraph(org.name, title_style)
-    flow.append(title)
-    flow.append(spacer)
-
-    c = Contact.objects.filter(obj=org)
-    if len(c) == 0:
-        return
-
-    c = c[0]
-    addr = c.line_1
-    if c.line_2:
-        addr += ', ' + c.line_2
-    if c.line_3:
-        addr += ', ' + c.line_3
 
     table_width = w
     title_width = 0.8*inch
     value_width = table_width - title_width
-    widths = (title_width, value_width)
+    list_widths = (title_width, value_width)
 
     LIST_STYLE = TableStyle(
         [('LINEBELOW', (0, 0), (-1, -2), 0.25, colors.black),
@@ -63,50 +57,80 @@ def append_org_form(org, flow, page_size):
          ('LINEAFTER', (0, 0), (0, -1), 0.25, colors.black),
          ])
 
-    table = Table((('Address', addr),
-                   ('Postcode', c.postcode),
-                   ('Town', c.town),
-                   ('E-mail', c.email),
-                   ('Website', c.website),
-                   ('Telephone', c.telephone),
-                   ('Mobile', c.mobile),
-                   ('Fax', c.fax),
-                   ), style=LIST_STYLE, colWidths=widths)
-    flow.append(table)
-
     BOX_STYLE = TableStyle(
         [('LINEBELOW', (0, 0), (-1, 0), 1.0, colors.black),
          ('ALIGNMENT', (0, 0), (-1, -1), 'CENTRE'),
          ('LINEBELOW', (0, 1), (-1, -1), 0.25, colors.black),
          ])
-    m_data = (('Name', 'Telephone', 'E-mail'), )
-    widths = (w*0.30, w*0.25, w*0.45)
+    box_widths = (w*0.30, w*0.25, w*0.45)
 
     txt_style = deepcopy(styles["Normal"])
     txt_style.fontSize = 10
     txt_style.alignment = TA_LEFT
-    flow.append(spacer)
-    flow.append(Paragraph('List of people who can be contacted:', txt_style))
-
-    members = Member.objects.filter(organisation=org)
-    for m in members[:10]:
-        c = Contact.objects.filter(obj=m)
-        if not c:
-            c = Contact.objects.filter(obj=m.person)
-        if c:
-            c = c[0]
-            tel = c.telephone
-            if not tel:
-                tel = c.mobile
-            email = c.email
-        else:
-            tel = ''
-            email = ''
-        m_data += ((m.person.__unicode__(), tel, email), )
-
-    for i in range(len(members), 10):
-        m_data += (('', '', ''), )
-
-    table = Table(m_data, style=BOX_STYLE, colWidths=widths)
-    flow.append(spacer)
-    flow.append(table)
+
+    org_members = dict((org.pk, list()) for org in orgs)
+    members = Member.objects.filter(organisation__in=org_members)
+    members = members.select_related('person').order_by('basic_name', 'pk')
+    for m in members:
+        org_members[m.organisation_id].append(m)
+
+    obj_ids = set(org_members)
+    for members in org_members.values():
+        for m in members[:10]:
+            obj_ids.update([m.pk, m.person_id])
+    contacts = dict()
+    for c in Contact.objects.filter(obj__in=obj_ids).order_by('-pk'):
+        contacts[c.obj_id] = c
+
+    for org in orgs:
+        title = Paragraph(org.name, title_style)
+        flow.append(title)
+        flow.append(spacer)
+
+        c = contacts.get(org.pk)
+        if c is None:
+            continue
+
+        addr = c.line_1
+        if c.line_2:
+            addr += ', ' + c.line_2
+        if c.line_3:
+            addr += ', ' + c.line_3
+
+        table = Table((('Address', addr),
+                       ('Postcode', c.postcode),
+                       ('Town', c.town),
+                       ('E-mail', c.email),
+                       ('Website', c.website),
+                       ('Telephone', c.telephone),
+                       ('Mobile', c.mobile),
+                       ('Fax', c.fax),
+                       ), style=LIST_STYLE, colWidths=list_widths)
+        flow.append(table)
+
+        m_data = (('Name', 'Telephone', 'E-mail'), )
+        flow.append(spacer)
+        flow.append(Paragraph('List of people who can be contacted:',
+                              txt_style))
+
+        members = org_members[org.pk]
+        for m in members[:10]:
+            c = contacts.get(m.pk)
+            if c is None:
+                c = contacts.get(m.person_id)
+            if c is not None:
+                tel = c.telephone
+                if not tel:
+                    tel = c.mobile
+                email = c.email
+            else:
+                tel = ''
+                email = ''
+            m_data += ((m.person.__unicode__(), tel, email), )
+
+        for i in range(len(members), 10):
+            m_data += (('', '', ''), )
+
+        table = Table(m_data, style=BOX_STYLE, colWidths=box_widths)
+        flow.append(spacer)
+        flow.append(table)
@@ -0,0 +1,479 @@
+# CAMS - search.py
+#
+# Copyright (C) 2009, 2010, 2011. 2012, 2013
+# Guillaume Tucker <guillaume@mangoz.org>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import math
+import heapq
+import threading
+from array import array
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete, post_syncdb
+from cams.models import (Contactable, Person, Organisation, Member, Contact,
+                         ContactableIndex)
+
+# -----------------------------------------------------------------------------
+# address book search index
+
+# The index contains the names, nicknames, organisation names and contact
+# e-mail addresses and postcodes of each address book entry.  It is stored in
+# ContactableIndex and also in an FTS table with SQLite, or indexed with a GIN
+# index on its tsvector with PostgreSQL.  Words are matched by prefix with
+# these, or as sub-strings with other databases.  The index is updated when
+# entries and contacts are saved or deleted.
+class ContactableSearch(object):
+    fts_table = 'cams_abook_search_fts'
+    tsv_index = 'cams_abook_search_tsv'
+
+    # Create the FTS table or the tsvector index, which is done after syncdb
+    # and by the cams_search_index command
+    def install(self):
+        cursor = connection.cursor()
+        if connection.vendor == 'sqlite':
+            cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS {} '
+                           'USING fts4(text)'.format(self.fts_table))
+        elif connection.vendor == 'postgresql':
+            cursor.execute('SELECT 1 FROM pg_class WHERE relname = %s',
+                           [self.tsv_index])
+            if cursor.fetchone() is None:
+                cursor.execute('CREATE INDEX {} ON {} USING gin '
+                               '(to_tsvector(\'simple\', text))'.format
+                               (self.tsv_index,
+                                ContactableIndex._meta.db_table))
+
+    def rebuild(self, batch_size=1000):
+        table = connection.ops.quote_name(ContactableIndex._meta.db_table)
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM {}'.format(table))
+        if connection.vendor == 'sqlite':
+            cursor.execute('DELETE FROM {}'.format(self.fts_table))
+        last_pk = 0
+        n = 0
+        while True:
+            pks = Contactable.objects.filter(pk__gt=last_pk).order_by('pk')
+            pks = list(pks.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            self.update(pks)
+            last_pk = pks[-1]
+            n += len(pks)
+        return n
+
+    def update(self, pks):
+        pks = set(pks)
+        words = dict()
+        for pk, name in Contactable.objects.filter(pk__in=pks). \
+                values_list('pk', 'basic_name'):
+            words[pk] = [name]
+        for pk, nickname in Person.objects.filter(pk__in=pks). \
+                values_list('pk', 'nickname'):
+            words[pk].append(nickname)
+        for pk, name, nickname in Organisation.objects.filter(pk__in=pks). \
+                values_list('pk', 'name', 'nickname'):
+            words[pk] += [name, nickname]
+        for row in Member.objects.filter(pk__in=pks).values_list \
+                ('pk', 'person__nickname', 'organisation__name',
+                 'organisation__nickname'):
+            words[row[0]] += row[1:]
+        for pk, email, postcode in Contact.objects.filter(obj__in=words). \
+                values_list('obj', 'email', 'postcode'):
+            words[pk] += [email, postcode]
+        texts = dict((pk, u' '.join(w for w in pk_words if w).lower())
+                     for pk, pk_words in words.items())
+        with transaction.atomic():
+            self.remove(pks)
+            ContactableIndex.objects.bulk_create \
+                ([ContactableIndex(contactable_id=pk, text=text)
+                  for pk, text in texts.items()])
+            if connection.vendor == 'sqlite':
+                connection.cursor().executemany \
+                    ('INSERT INTO {} (rowid, text) VALUES (%s, %s)'.format
+                     (self.fts_table), list(texts.items()))
+
+    def remove(self, pks):
+        pks = list(pks)
+        ContactableIndex.objects.filter(contactable__in=pks).delete()
+        if connection.vendor == 'sqlite' and pks:
+            connection.cursor().execute \
+                ('DELETE FROM {} WHERE rowid IN ({})'.format
+                 (self.fts_table, ', '.join(['%s'] * len(pks))), pks)
+
+    def get_words(self, text):
+        return re.findall(r'\w+', text.lower(), re.UNICODE)
+
+    # Get the ids of the entries matching all the words in the text
+    def match(self, text):
+        words = self.get_words(text)
+        qs = ContactableIndex.objects.all()
+        if not words:
+            pass
+        elif connection.vendor == 'sqlite':
+            where = 'contactable_id IN (SELECT rowid FROM {} ' \
+                'WHERE text MATCH %s)'.format(self.fts_table)
+            qs = qs.extra(where=[where],
+                          params=[' '.join(w + '*' for w in words)])
+        elif connection.vendor == 'postgresql':
+            where = 'to_tsvector(\'simple\', text) @@ ' \
+                'to_tsquery(\'simple\', %s)'
+            qs = qs.extra(where=[where],
+                          params=[' & '.join(w + ':*' for w in words)])
+        else:
+            for w in words:
+                qs = qs.filter(text__contains=w)
+        return qs.values('contactable')
+
+contactable_search = ContactableSearch()
+
+# -----------------------------------------------------------------------------
+# address book autocompletion
+
+# In-memory index of the address book entry names and nicknames for the
+# autocompletion as the user types, loaded from the database on first use and
+# then kept up to date by the signal handlers.  Each entry has a slot number
+# used in the parallel arrays below.  The texts are the lower-case words of
+# the names and nicknames, stored with the names in a single character array
+# with the start and lengths of each in the slot arrays; the space left by
+# removed entries is reclaimed when it reaches half of the array.  Two sorted
+# arrays of (slot, offset) pairs point to the beginning of each text for the
+# first ones and to the other words for the second ones so prefixes can be
+# found with a binary search.  The trigrams map each trigram to the array of
+# slots which contain it for fuzzy searches.
+class ContactableAutocomplete(object):
+    chunk_size = 500
+    max_postings = 1000
+    max_candidates = 30
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._clear()
+
+    def _clear(self):
+        self._slots = dict()
+        self._free = list()
+        self._pks = array('l')
+        self._flags = array('B')
+        self._ngrams = array('H')
+        self._starts = array('l')
+        self._text_lens = array('H')
+        self._name_lens = array('H')
+        self._chars = array('u')
+        self._garbage = 0
+        self._heads = (array('l'), array('H'))
+        self._words = (array('l'), array('H'))
+        self._trigrams = dict()
+
+    def rebuild(self):
+        entries = self._get_entries(Contactable.objects.all())
+        with self._lock:
+            self._clear()
+            heads = list()
+            words = list()
+            for entry in entries:
+                slot = self._add_entry(*entry)
+                offsets = self._get_offsets(self._get_text(slot))
+                heads.append((slot, 0))
+                words += ((slot, offset) for offset in offsets[1:])
+            for keys, pairs in ((self._heads, heads), (self._words, words)):
+                pairs.sort(key=lambda pair: self._get_text(*pair))
+                keys[0].extend(pair[0] for pair in pairs)
+                keys[1].extend(pair[1] for pair in pairs)
+            self._loaded = True
+        return len(entries)
+
+    def update(self, pks):
+        if not self._loaded:
+            return
+        pks = list(pks)
+        entries = list()
+        for i in range(0, len(pks), self.chunk_size):
+            entries += self._get_entries(Contactable.objects.filter
+                                         (pk__in=pks[i:(i + self.chunk_size)]))
+        with self._lock:
+            self._remove(pks)
+            for entry in entries:
+                slot = self._add_entry(*entry)
+                offsets = self._get_offsets(self._get_text(slot))
+                self._insort(self._heads, slot, 0)
+                for offset in offsets[1:]:
+                    self._insort(self._words, slot, offset)
+
+    def remove(self, pks):
+        if not self._loaded:
+            return
+        pks = list(pks)
+        with self._lock:
+            self._remove(pks)
+
+    # Get the entries with a name or nickname starting with the text, or with
+    # a word in them starting with the text.  The first ones are returned
+    # first, in alphabetical order.  The results are (pk, type, status, name)
+    # tuples, optionally filtered by type and status.
+    def complete(self, text, limit=10, types=None, statuses=None):
+        prefix = self._normalise(text)
+        if not prefix:
+            return list()
+        with self._lock:
+            self._load()
+            results = list()
+            found = set()
+            for keys in (self._heads, self._words):
+                slots, offsets = keys
+                i = self._bisect(keys, prefix)
+                while (i < len(slots)) and (len(results) < limit):
+                    slot = slots[i]
+                    if not self._get_text(slot, offsets[i]).startswith(prefix):
+                        break
+                    if (slot not in found) and \
+                            self._match_flags(slot, types, statuses):
+                        found.add(slot)
+                        results.append(self._get_result(slot))
+                    i += 1
+            return results
+
+    # Get the entries with the most trigrams in common with the text, to find
+    # names with typos or in a different order.  They are ranked by the
+    # number of text trigrams found in the entry, which has to be at least
+    # the threshold proportion of them, and then by the number of common
+    # trigrams divided by the number of distinct ones in both to favour the
+    # closest names.  An entry with m trigrams in common out of n has at least
+    # one of any n - m + 1 of them, so the candidates are only taken from the
+    # slot arrays of the rarest ones, up to max_postings slots in total, and
+    # grouped by the number of these arrays they appear in.  Up to
+    # max_candidates of them are then checked against all the text trigrams,
+    # starting with the ones in the most arrays.  This keeps each search well
+    # under 1 ms with 100k entries, but when all the text trigrams are very
+    # common only some of the matching entries are considered.
+    def search(self, text, limit=10, types=None, statuses=None,
+               threshold=0.3):
+        trigrams = self._get_trigrams(self._normalise(text))
+        if not trigrams:
+            return list()
+        min_n = max(1, int(math.ceil(threshold * len(trigrams))))
+        with self._lock:
+            self._load()
+            postings = sorted((self._trigrams.get(trigram, ())
+                               for trigram in trigrams), key=len)
+            levels = list()
+            budget = self.max_postings
+            for slots in postings[:(len(trigrams) - min_n + 1)]:
+                if len(slots) > budget:
+                    if budget < self.max_postings:
+                        break
+                    slots = slots[:budget]
+                budget -= len(slots)
+                slots = set(slots)
+                for i in reversed(range(len(levels))):
+                    common = levels[i] & slots
+                    if not common:
+                        continue
+                    if (i + 1) == len(levels):
+                        levels.append(common)
+                    else:
+                        levels[i + 1] |= common
+                if levels:
+                    levels[0] |= slots
+                else:
+                    levels.append(slots)
+            scores = list()
+            checked = 0
+            above = set()
+            for level in reversed(levels):
+                if (len(scores) >= limit) or \
+                        (checked >= self.max_candidates):
+                    break
+                for slot in level - above:
+                    if checked >= self.max_candidates:
+                        break
+                    checked += 1
+                    if not self._match_flags(slot, types, statuses):
+                        continue
+                    padded = u' ' + self._get_text(slot) + u' '
+                    n = len([trigram for trigram in trigrams
+                             if trigram in padded])
+                    if n >= min_n:
+                        similarity = float(n) / (len(trigrams) +
+                                                 self._ngrams[slot] - n)
+                        scores.append((-n, -similarity,
+                                       self._get_name(slot), slot))
+                above = level
+            return list(self._get_result(score[-1]) for score in
+                        heapq.nsmallest(limit, scores))
+
+    def _load(self):
+        if not self._loaded:
+            self.rebuild()
+
+    def _get_entries(self, contactables):
+        rows = list(contactables.values_list('pk', 'type', 'status',
+                                             'basic_name'))
+        ids = contactables.values('pk')
+        nicknames = dict()
+        for model, field in ((Person, 'nickname'),
+                             (Organisation, 'nickname'),
+                             (Member, 'person__nickname')):
+            nicknames.update(model.objects.filter(pk__in=ids). \
+                                 exclude(**{field: ''}). \
+                                 values_list('pk', field))
+        return list(row + (nicknames.get(row[0], u''), ) for row in rows)
+
+    def _add_entry(self, pk, ctype, status, name, nickname):
+        text = self._normalise(u' '.join((name, nickname)))
+        trigrams = self._get_trigrams(text)
+        flags = (ctype << 4) | status
+        start = len(self._chars)
+        self._chars.fromunicode(text + name)
+        if self._free:
+            slot = self._free.pop()
+            self._pks[slot] = pk
+            self._flags[slot] = flags
+            self._ngrams[slot] = len(trigrams)
+            self._starts[slot] = start
+            self._text_lens[slot] = len(text)
+            self._name_lens[slot] = len(name)
+        else:
+            slot = len(self._pks)
+            self._pks.append(pk)
+            self._flags.append(flags)
+            self._ngrams.append(len(trigrams))
+            self._starts.append(start)
+            self._text_lens.append(len(text))
+            self._name_lens.append(len(name))
+        self._slots[pk] = slot
+        for trigram in trigrams:
+            self._trigrams.setdefault(trigram, array('l')).append(slot)
+        return slot
+
+    def _remove(self, pks):
+        for pk in pks:
+            slot = self._slots.pop(pk, None)
+            if slot is None:
+                continue
+            text = self._get_text(slot)
+            offsets = self._get_offsets(text)
+            self._delete(self._heads, slot, 0)
+            for offset in offsets[1:]:
+                self._delete(self._words, slot, offset)
+            for trigram in self._get_trigrams(text):
+                slots = self._trigrams[trigram]
+                slots.remove(slot)
+                if not slots:
+                    del self._trigrams[trigram]
+            self._pks[slot] = 0
+            self._garbage += self._text_lens[slot] + self._name_lens[slot]
+            self._text_lens[slot] = 0
+            self._name_lens[slot] = 0
+            self._free.append(slot)
+        if (self._garbage * 2) > len(self._chars):
+            self._compact()
+
+    def _compact(self):
+        chars = array('u')
+        for slot in range(len(self._pks)):
+            start = self._starts[slot]
+            end = start + self._text_lens[slot] + self._name_lens[slot]
+            self._starts[slot] = len(chars)
+            chars.extend(self._chars[start:end])
+        self._chars = chars
+        self._garbage = 0
+
+    def _get_text(self, slot, offset=0):
+        start = self._starts[slot]
+        return self._chars[(start + offset):
+                           (start + self._text_lens[slot])].tounicode()
+
+    def _get_name(self, slot):
+        start = self._starts[slot] + self._text_lens[slot]
+        return self._chars[start:(start + self._name_lens[slot])].tounicode()
+
+    def _bisect(self, keys, key):
+        slots, offsets = keys
+        lo, hi = 0, len(slots)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._get_text(slots[mid], offsets[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _insort(self, keys, slot, offset):
+        i = self._bisect(keys, self._get_text(slot, offset))
+        keys[0].insert(i, slot)
+        keys[1].insert(i, offset)
+
+    def _delete(self, keys, slot, offset):
+        slots, offsets = keys
+        i = self._bisect(keys, self._get_text(slot, offset))
+        while (slots[i] != slot) or (offsets[i] != offset):
+            i += 1
+        del slots[i]
+        del offsets[i]
+
+    def _match_flags(self, slot, types, statuses):
+        flags = self._flags[slot]
+        return (((types is None) or ((flags >> 4) in types)) and
+                ((statuses is None) or ((flags & 0xF) in statuses)))
+
+    def _get_result(self, slot):
+        flags = self._flags[slot]
+        return (self._pks[slot], flags >> 4, flags & 0xF,
+                self._get_name(slot))
+
+    def _normalise(self, text):
+        return u' '.join(re.findall(r'\w+', text.lower(), re.UNICODE))
+
+    def _get_offsets(self, text):
+        return list(m.start() for m in re.finditer(r'\w+', text, re.UNICODE))
+
+    def _get_trigrams(self, text):
+        if not text:
+            return set()
+        text = u' ' + text + u' '
+        return set(text[i:i + 3] for i in range(len(text) - 2))
+
+contactable_autocomplete = ContactableAutocomplete()
+
+
+def _update_contactable_index(sender, instance, **kwargs):
+    pks = [instance.pk]
+    if sender in (Person, Organisation):
+        members = Member.objects.filter(Q(person=instance.pk) |
+                                        Q(organisation=instance.pk))
+        pks += members.values_list('pk', flat=True)
+    contactable_search.update(pks)
+    contactable_autocomplete.update(pks)
+
+def _remove_contactable_index(sender, instance, **kwargs):
+    if issubclass(sender, Contactable):
+        contactable_search.remove([instance.pk])
+        contactable_autocomplete.remove([instance.pk])
+
+def _update_contact_index(sender, instance, **kwargs):
+    contactable_search.update([instance.obj_id])
+
+def _install_search(sender, **kwargs):
+    if sender.__name__ == Contactable.__module__:
+        contactable_search.install()
+
+post_syncdb.connect(_install_search)
+for model in (Person, Organisation, Member):
+    post_save.connect(_update_contactable_index, sender=model)
+post_delete.connect(_remove_contactable_index)
+post_save.connect(_update_contact_index, sender=Contact)
+post_delete.connect(_update_contact_index, sender=Contact)
@@ -0,0 +1,280 @@
+# CAMS - tests.py
+#
+# Copyright (C) 2009, 2010, 2011. 2012, 2013
+# Guillaume Tucker <guillaume@mangoz.org>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import date, timedelta
+from StringIO import StringIO
+from django.contrib import admin
+from django.contrib.admin.util import lookup_field
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from cams.models import (Person, Organisation, Member, Group, Role, PinBoard,
+                         Contactable, Fair, Player, Event, Actor, EventComment,
+                         EventApplication, Contact)
+from cams.contacts import iterate_group_contacts
+from cams import admin as cams_admin
+
+# -----------------------------------------------------------------------------
+# admin change lists
+
+# Each change list is rendered with 10 and then 500 rows in the database, and
+# must run the same number of queries in both cases.
+class ChangeListQueriesTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser('admin', 'admin@cams.org',
+                                                  'admin')
+        self.board = PinBoard.objects.create(name='2012')
+        self.n = 0
+
+    def assertChangeListQueries(self, model_admin_class, model, create):
+        model_admin = model_admin_class(model, admin.site)
+        create(10)
+        with CaptureQueriesContext(connection) as queries:
+            self._render_change_list(model_admin)
+        create(490)
+        with self.assertNumQueries(len(queries)):
+            self._render_change_list(model_admin)
+
+    # Same as the admin change list view, without the template
+    def _render_change_list(self, model_admin):
+        request = RequestFactory().get('/')
+        request.user = self.user
+        request.resolver_match = None
+        list_display = model_admin.get_list_display(request)
+        cl = model_admin.get_changelist(request)(
+            request, model_admin.model, list_display,
+            model_admin.list_display_links, model_admin.list_filter,
+            model_admin.date_hierarchy,
+            model_admin.search_fields, model_admin.list_select_related,
+            model_admin.list_per_page, model_admin.list_max_show_all,
+            model_admin.list_editable, model_admin)
+        for obj in cl.result_list:
+            for name in list_display:
+                unicode(lookup_field(name, obj, model_admin)[2])
+
+    def _add_person(self):
+        self.n += 1
+        p = Person.objects.create(first_name='First{}'.format(self.n),
+                                  last_name='Last')
+        current = Group.objects.create(name='Group{}'.format(self.n))
+        pinned = Group.objects.create(name='Group{}'.format(self.n),
+                                      board=self.board)
+        for g in (current, pinned):
+            Role.objects.create(contactable=p, group=g)
+        return p
+
+    def _add_org(self):
+        self.n += 1
+        o = Organisation.objects.create(name='Org{}'.format(self.n))
+        Role.objects.create(contactable=o, group=Group.objects.create
+                            (name='Group{}'.format(self.n)))
+        return o
+
+    def test_person(self):
+        self.assertChangeListQueries(
+            cams_admin.PersonAdmin, Person,
+            lambda n: [self._add_person() for i in range(n)])
+
+    def test_organisation(self):
+        self.assertChangeListQueries(
+            cams_admin.OrganisationAdmin, Organisation,
+            lambda n: [self._add_org() for i in range(n)])
+
+    def test_current_groups(self):
+        p = self._add_person()
+        self.assertEqual(p.current_groups, 'Group1')
+        p = Contactable.objects.prefetch_related('group_set').get(pk=p.pk)
+        self.assertEqual(p.current_groups, 'Group1')
+
+    def _add_member(self):
+        self.n += 1
+        return Member.objects.create(
+            person=Person.objects.create(first_name='First{}'.format(self.n),
+                                         last_name='Last'),
+            organisation=Organisation.objects.create
+            (name='Org{}'.format(self.n)))
+
+    def _add_player(self):
+        self.n += 1
+        return Player.objects.create(
+            person=Person.objects.create(first_name='First{}'.format(self.n),
+                                         last_name='Last'),
+            user=User.objects.create_user('user{}'.format(self.n)))
+
+    def _add_event(self):
+        self.n += 1
+        return Event.objects.create(
+            name='Event{}'.format(self.n), date=date(2013, 1, 1),
+            owner=Person.objects.create(first_name='First{}'.format(self.n),
+                                        last_name='Last'),
+            org=Organisation.objects.create(name='Org{}'.format(self.n)))
+
+    def test_member(self):
+        self.assertChangeListQueries(
+            cams_admin.MemberAdmin, Member,
+            lambda n: [self._add_member() for i in range(n)])
+
+    def test_group(self):
+        def create(n):
+            for i in range(n):
+                self.n += 1
+                Group.objects.create(name='Group{}'.format(self.n),
+                                     board=self.board)
+        self.assertChangeListQueries(cams_admin.GroupAdmin, Group, create)
+
+    def test_fair(self):
+        def create(n):
+            for i in range(n):
+                self.n += 1
+                Fair.objects.create(date=(date(2000, 1, 1) +
+                                          timedelta(days=self.n)))
+        self.assertChangeListQueries(cams_admin.FairAdmin, Fair, create)
+
+    def test_player(self):
+        self.assertChangeListQueries(
+            cams_admin.PlayerAdmin, Player,
+            lambda n: [self._add_player() for i in range(n)])
+
+    def test_event(self):
+        self.assertChangeListQueries(
+            cams_admin.EventAdmin, Event,
+            lambda n: [self._add_event() for i in range(n)])
+
+    def test_actor(self):
+        def create(n):
+            for i in range(n):
+                event = self._add_event()
+                Actor.objects.create(person=event.owner, event=event)
+        self.assertChangeListQueries(cams_admin.ActorAdmin, Actor, create)
+
+    def test_event_comment(self):
+        def create(n):
+            for i in range(n):
+                EventComment.objects.create(author=self._add_player(),
+                                            event=self._add_event(),
+                                            text='Comment')
+        self.assertChangeListQueries(cams_admin.EventCommentAdmin,
+                                     EventComment, create)
+
+    def test_event_application(self):
+        def create(n):
+            for i in range(n):
+                event = self._add_event()
+                EventApplication.objects.create(person=event.owner,
+                                                event=event)
+        self.assertChangeListQueries(cams_admin.EventApplicationAdmin,
+                                     EventApplication, create)
+
+# -----------------------------------------------------------------------------
+# address book
+
+class PrimaryContactTest(TestCase):
+    def test_command(self):
+        p = Person.objects.create(first_name='First', last_name='Last')
+        c = Contact.objects.create(obj=p, email='p@cams.org')
+        self.assertEqual(Person.objects.get(pk=p.pk).contact, c)
+        Contactable.objects.update(primary_contact=None)
+        self.assertEqual(Person.objects.get(pk=p.pk).contact, None)
+        call_command('cams_primary_contacts', batch_size=1,
+                     stdout=StringIO())
+        self.assertEqual(Person.objects.get(pk=p.pk).contact, c)
+
+class StatusTest(TestCase):
+    # Member.propagate_status() looks up the members to update in subqueries
+    def _count_propagations(self, obj):
+        with CaptureQueriesContext(connection) as queries:
+            obj.save()
+        return len(list(q for q in queries.captured_queries
+                        if '"cams_abook_member" U0' in q['sql']))
+
+    def test_propagate(self):
+        p = Person.objects.create(first_name='First', last_name='Last')
+        o = Organisation.objects.create(name='Org')
+        m = Member.objects.create(person=p, organisation=o)
+        o = Organisation.objects.get(pk=o.pk)
+        self.assertEqual(self._count_propagations(o), 0)
+        o.status = Contactable.DISABLED
+        self.assertNotEqual(self._count_propagations(o), 0)
+        self.assertEqual(Member.objects.get(pk=m.pk).status,
+                         Contactable.DISABLED)
+        self.assertEqual(self._count_propagations(o), 0)
+
+# -----------------------------------------------------------------------------
+# management
+
+class FairTest(TestCase):
+    def test_current(self):
+        first = Fair.objects.create(date=date(2012, 1, 1))
+        self.assertEqual(Fair.get_current(), first)
+        second = Fair.objects.create(date=date(2013, 1, 1), current=True)
+        self.assertEqual(Fair.get_current(), second)
+        self.assertEqual(list(Fair.objects.values_list('pk', 'current')),
+                         [(second.pk, True), (first.pk, False)])
+        Fair.objects.get(pk=first.pk).save()
+        self.assertEqual(Fair.get_current(), second)
+
+# -----------------------------------------------------------------------------
+# contacts
+
+# The group contacts are resolved with the same number of queries for any
+# number of roles, using each of the fallback rules.
+class GroupContactsQueriesTest(TestCase):
+    def setUp(self):
+        self.group = Group.objects.create(name='Group')
+        self.n = 0
+
+    def _add_roles(self, n):
+        for i in range(n):
+            self.n += 1
+            p = Person.objects.create(first_name='First{}'.format(self.n),
+                                      last_name='Last')
+            o = Organisation.objects.create(name='Org{}'.format(self.n))
+            m = Member.objects.create(person=p, organisation=o)
+            # person -> member contact, org -> member contact
+            Contact.objects.create(obj=m, email='m{}@cams.org'.format(self.n))
+            # person -> own contact
+            p2 = Person.objects.create(first_name='Second{}'.format(self.n),
+                                       last_name='Last')
+            Contact.objects.create(obj=p2, email='p{}@cams.org'.format(self.n))
+            # person -> org contact
+            p3 = Person.objects.create(first_name='Third{}'.format(self.n),
+                                       last_name='Last')
+            o3 = Organisation.objects.create(name='OrgB{}'.format(self.n))
+            Member.objects.create(person=p3, organisation=o3)
+            Contact.objects.create(obj=o3, email='o{}@cams.org'.format(self.n))
+            for c in (p, o, p2, p3, o3):
+                Role.objects.create(contactable=c, group=self.group)
+
+    def _get_contacts(self):
+        return list((it.ctype, it.c.email)
+                    for it, role in iterate_group_contacts(self.group))
+
+    def test_queries(self):
+        self._add_roles(2)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(len(self._get_contacts()), 10)
+        self._add_roles(100)
+        with self.assertNumQueries(len(queries)):
+            contacts = self._get_contacts()
+        self.assertEqual(len(contacts), 510)
+        self.assertIn(('member', 'm1@cams.org'), contacts)
+        self.assertIn(('person', 'p1@cams.org'), contacts)
+        self.assertIn(('org', 'o1@cams.org'), contacts)